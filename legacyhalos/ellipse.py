@@ -7,8 +7,8 @@ Code to do ellipse fitting on the residual coadds.
 """
 from __future__ import absolute_import, division, print_function
 
-import os, pdb
 import time, warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import numpy.ma as ma
@@ -16,6 +16,22 @@ import matplotlib.pyplot as plt
 
 import legacyhalos.io
 
+def _geometries_to_soa(isolist):
+    """Unpack the sample geometries of an isophote list into contiguous arrays.
+
+    Reading iso.sample.geometry attribute-by-attribute for every isophote in
+    every band walks a Python object graph each time; pulling the geometry
+    (sma, x0, y0, eps, pa) into numpy arrays once lets the per-band resampling
+    loop read contiguous floats instead.
+
+    """
+    niso = len(isolist)
+    sma, x0, y0, eps, pa = [np.empty(niso) for _ in range(5)]
+    for ii, iso in enumerate(isolist):
+        g = iso.sample.geometry
+        sma[ii], x0[ii], y0[ii], eps[ii], pa[ii] = g.sma, g.x0, g.y0, g.eps, g.pa
+    return sma, x0, y0, eps, pa
+
 def ellipsefit_multiband(objid, objdir, data, sample, mgefit,
                          nowrite=False, verbose=False):
     """Ellipse-fit the multiband data.
@@ -94,22 +110,23 @@ def ellipsefit_multiband(objid, objdir, data, sample, mgefit,
             ellipsefit[refband] = isophot
 
             tall = time.time()
-            for filt in band:
-                t0 = time.time()
-                if filt == refband: # we did it already!
-                    continue
 
+            # Unpack the fixed reference-band geometries once, up front.
+            smas, x0s, y0s, epss, pas = _geometries_to_soa(isophot)
+
+            def _resample_one_band(filt):
+                """Resample the reference-band isophotes onto one bandpass."""
+                t0 = time.time()
                 if verbose:
                     print('Ellipse-fitting {}-band image.'.format(filt))
 
                 img = data['{}_masked'.format(filt)]
 
-                # Loop on the reference band isophotes but skip the first isophote,
-                # which is a CentralEllipseSample object (see below).
+                # Loop on the reference band isophote geometries.
                 isobandfit = []
-                for iso in isophot:
-                #for iso in isophot[1:]:
-                    g = iso.sample.geometry # fixed geometry
+                for ii in range(len(smas)):
+                    g = EllipseGeometry(x0=x0s[ii], y0=y0s[ii], sma=smas[ii],
+                                        eps=epss[ii], pa=pas[ii]) # fixed geometry
 
                     # Use the same integration mode and clipping parameters.
                     sample = EllipseSample(img, g.sma, geometry=g, integrmode=integrmode,
@@ -121,7 +138,6 @@ def ellipsefit_multiband(objid, objdir, data, sample, mgefit,
 
                 # Now deal with the central pixel; see
                 # https://github.com/astropy/photutils-datasets/blob/master/notebooks/isophote/isophote_example4.ipynb
-                #import pdb ; pdb.set_trace()
                 #g = EllipseGeometry(x0=geometry.x0, y0=geometry.y0, eps=mgefit['eps'], sma=1.0)
                 #g.find_center(img)
 
@@ -132,11 +148,21 @@ def ellipsefit_multiband(objid, objdir, data, sample, mgefit,
                 #isobandfit.append(cen)
                 #isobandfit.sort()
 
-                # Build the IsophoteList instance with the result.
-                ellipsefit[filt] = IsophoteList(isobandfit)
                 if verbose:
                     print('Time = {:.3f} sec'.format( (time.time() - t0) / 1))
 
+                # Build the IsophoteList instance with the result.
+                return filt, IsophoteList(isobandfit)
+
+            # The non-reference bands are independent of one another, and the
+            # heavy lifting in EllipseSample.update is NumPy code that
+            # releases the GIL, so resample them in parallel with threads.
+            otherbands = [filt for filt in band if filt != refband]
+            if otherbands:
+                with ThreadPoolExecutor(max_workers=len(otherbands)) as pool:
+                    for filt, isobandfit in pool.map(_resample_one_band, otherbands):
+                        ellipsefit[filt] = isobandfit
+
             if verbose:
                 print('Time for all images = {:.3f} sec'.format( (time.time() - tall) / 1))
                 
@@ -196,7 +222,35 @@ def ellipse_sbprofile(ellipsefit, minerr=0.02):
 
     return sbprofile
 
-def mgefit_multiband(objid, objdir, data, debug=False, nowrite=False,
+def _run_mge_one_band(filt, img, mask, eps, theta, xmed, ymed, pixscale, debug):
+    """Run sectors photometry plus the MGE fit on a single bandpass.
+
+    This lives at module level (and takes plain arrays/scalars rather than
+    the find_galaxy result object) so it can be pickled and dispatched to
+    worker processes; fit_sectors does not release the GIL, so threads
+    would not help here.  img and mask may also be .npy file names, which
+    workers open memory-mapped instead of receiving a pickled copy.
+
+    """
+    from mge.sectors_photometry import sectors_photometry
+    from mge.mge_fit_sectors import mge_fit_sectors as fit_sectors
+
+    if isinstance(img, str):
+        img = np.load(img, mmap_mode='r')
+    if isinstance(mask, str):
+        mask = np.load(mask, mmap_mode='r')
+
+    mgephot = sectors_photometry(img, eps, theta, xmed, ymed, n_sectors=11,
+                                 minlevel=0, plot=debug, mask=mask)
+
+    mgeband = fit_sectors(mgephot.radius, mgephot.angle, mgephot.counts,
+                          eps, ngauss=None, negative=False,
+                          sigmaPSF=0, normPSF=1, scale=pixscale,
+                          quiet=not debug, outer_slope=4, bulge_disk=False,
+                          plot=debug)
+    return filt, mgeband
+
+def mgefit_multiband(objid, objdir, data, ncpu=1, debug=False, nowrite=False,
                      nofit=True, verbose=False):
     """MGE-fit the multiband data.
 
@@ -204,8 +258,6 @@ def mgefit_multiband(objid, objdir, data, debug=False, nowrite=False,
 
     """
     from mge.find_galaxy import find_galaxy
-    from mge.sectors_photometry import sectors_photometry
-    from mge.mge_fit_sectors import mge_fit_sectors as fit_sectors
     #from mge.mge_print_contours import mge_print_contours as print_contours
 
     band, refband, pixscale = data['band'], data['refband'], data['pixscale']
@@ -232,29 +284,37 @@ def mgefit_multiband(objid, objdir, data, debug=False, nowrite=False,
 
     if not nofit:
         t0 = time.time()
-        for filt in band:
-            if verbose:
-                print('Running MGE on the {}-band image.'.format(filt))
-
-            mgephot = sectors_photometry(data[filt], galaxy.eps, galaxy.theta, galaxy.xmed,
-                                         galaxy.ymed, n_sectors=11, minlevel=0, plot=debug,
-                                         mask=data['{}_mask'.format(filt)])
-            if debug:
-                #plt.show()
-                pass
-
-            mgefit[filt] = fit_sectors(mgephot.radius, mgephot.angle, mgephot.counts,
-                                       galaxy.eps, ngauss=None, negative=False,
-                                       sigmaPSF=0, normPSF=1, scale=pixscale,
-                                       quiet=not debug, outer_slope=4, bulge_disk=False,
-                                       plot=debug)
-            if debug:
-                pass
-                #plt.show()
-
-            #_ = print_contours(data[refband], galaxy.pa, galaxy.xpeak, galaxy.ypeak, pp.sol, 
-            #                   binning=2, normpsf=1, magrange=6, mask=None, 
-            #                   scale=pixscale, sigmapsf=0)
+
+        # The per-band photometry + MGE fits are independent, so run them in
+        # worker processes when ncpu > 1; stay serial when debugging so the
+        # interactive plots still work.
+        if ncpu > 1 and not debug:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(max_workers=min(len(band), ncpu)) as pool:
+                futures = [pool.submit(_run_mge_one_band, filt,
+                                       data.get('{}_filename'.format(filt), data[filt]),
+                                       data.get('{}_mask_filename'.format(filt),
+                                                data['{}_mask'.format(filt)]),
+                                       galaxy.eps, galaxy.theta, galaxy.xmed,
+                                       galaxy.ymed, pixscale, False)
+                           for filt in band]
+                for future in as_completed(futures):
+                    filt, mgeband = future.result()
+                    mgefit[filt] = mgeband
+        else:
+            for filt in band:
+                if verbose:
+                    print('Running MGE on the {}-band image.'.format(filt))
+
+                _, mgefit[filt] = _run_mge_one_band(filt, data[filt],
+                                                    data['{}_mask'.format(filt)],
+                                                    galaxy.eps, galaxy.theta,
+                                                    galaxy.xmed, galaxy.ymed,
+                                                    pixscale, debug)
+
+                #_ = print_contours(data[refband], galaxy.pa, galaxy.xpeak, galaxy.ypeak, pp.sol,
+                #                   binning=2, normpsf=1, magrange=6, mask=None,
+                #                   scale=pixscale, sigmapsf=0)
 
         if verbose:
             print('Time = {:.3f} sec'.format( (time.time() - t0) / 1))
@@ -273,12 +333,14 @@ def legacyhalos_ellipse(sample, objid=None, objdir=None, ncpu=1,
     if objid is None and objdir is None:
         objid, objdir = get_objid(sample)
 
-    # Read the data.  
+    # Read the data (memory-mapped when we're going to fan out to worker
+    # processes, so they share pages instead of copying the images).
     data = legacyhalos.io.read_multiband(objid, objdir, band=band, refband=refband,
-                                         pixscale=pixscale)
+                                         pixscale=pixscale, use_mmap=ncpu > 1)
     if bool(data):
         # Find the galaxy and perform MGE fitting.
-        mgefit = mgefit_multiband(objid, objdir, data, verbose=verbose, debug=debug)
+        mgefit = mgefit_multiband(objid, objdir, data, ncpu=ncpu,
+                                  verbose=verbose, debug=debug)
 
         # Do ellipse-fitting.
         ellipsefit = ellipsefit_multiband(objid, objdir, data, sample, mgefit,
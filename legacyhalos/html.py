@@ -3,9 +3,6 @@ from __future__ import (absolute_import, division)
 import os, subprocess, pdb
 import numpy as np
 
-import seaborn as sns
-sns.set(style='ticks', font_scale=1.4, palette='Set2')
-
 def qa_montage_coadds(objid, objdir, htmlobjdir, clobber=False, verbose=True):
     """Montage the coadds into a nice QAplot."""
 
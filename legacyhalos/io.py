@@ -141,11 +141,18 @@ def read_catalog(extname='LSPHOT', upenn=True, isedfit=False, columns=None):
 
     return cat
 
-def read_multiband(objid, objdir, band=('g', 'r', 'z'), refband='r', pixscale=0.262):
+def read_multiband(objid, objdir, band=('g', 'r', 'z'), refband='r', pixscale=0.262,
+                   use_mmap=False):
     """Read the multi-band images, construct the residual image, and then create a
     masked array from the corresponding inverse variances image.  Finally,
     convert to surface brightness by dividing by the pixel area.
 
+    With use_mmap=True the residual images and masks are additionally cached
+    as .npy files in objdir and reopened memory-mapped (read-only), so
+    parallel workers share the OS page cache rather than each holding a
+    private copy; the file names are stored in the data dictionary so workers
+    can be handed a path instead of pickling the array.
+
     """
     import fitsio
     from scipy.ndimage.morphology import binary_dilation
@@ -177,8 +184,18 @@ def read_multiband(objid, objdir, band=('g', 'r', 'z'), refband='r', pixscale=0.
         mask = binary_dilation(mask, iterations=5) * 1
 
         data[filt] = (image - model) / pixscale**2 # [nanomaggies/arcsec**2]
-        
+
         data['{}_mask'.format(filt)] = mask == 0 # 1->bad
+
+        if use_mmap:
+            residfile = os.path.join(objdir, '{}-resid-{}.npy'.format(objid, filt))
+            maskfile = os.path.join(objdir, '{}-resid-mask-{}.npy'.format(objid, filt))
+            np.save(residfile, data[filt])
+            np.save(maskfile, data['{}_mask'.format(filt)])
+            data[filt] = np.load(residfile, mmap_mode='r')
+            data['{}_mask'.format(filt)] = np.load(maskfile, mmap_mode='r')
+            data['{}_filename'.format(filt)] = residfile
+            data['{}_mask_filename'.format(filt)] = maskfile
         data['{}_masked'.format(filt)] = ma.masked_array(data[filt], ~data['{}_mask'.format(filt)]) # 0->bad
         ma.set_fill_value(data['{}_masked'.format(filt)], 0)
 
@@ -12,11 +12,20 @@ import time
 import numpy as np
 import matplotlib.pyplot as plt
 
-import seaborn as sns
-sns.set(style='ticks', font_scale=1.4, palette='Set2')
-
 PIXSCALE = 0.262
 
+def _configure_style():
+    """Import seaborn and set the plotting style.
+
+    Deferred to the plotting entry points so that merely importing this
+    module (e.g., in a fitting-only worker process) doesn't pull in the
+    seaborn/pandas stack or mutate the matplotlib rcParams.
+
+    """
+    import seaborn as sns
+    sns.set(style='ticks', font_scale=1.4, palette='Set2')
+    return sns
+
 def display_multiband(data, geometry=None, mgefit=None, ellipsefit=None, indx=None,
                       magrange=10, inchperband=3, contours=False, png=None,
                       verbose=True):
@@ -28,6 +37,8 @@ def display_multiband(data, geometry=None, mgefit=None, ellipsefit=None, indx=No
     from astropy.visualization import AsinhStretch as Stretch
     from astropy.visualization import ImageNormalize
 
+    _configure_style()
+
     band = data['band']
     nband = len(band)
 
@@ -113,7 +124,7 @@ def display_ellipsefit(ellipsefit, xlog=False, png=None, verbose=True):
 
     from matplotlib.ticker import FormatStrFormatter, ScalarFormatter
 
-    colors = iter(sns.color_palette())
+    colors = iter(_configure_style().color_palette())
 
     band, refband = ellipsefit['band'], ellipsefit['refband']
     pixscale, redshift = ellipsefit['pixscale'], ellipsefit['redshift']
@@ -218,7 +229,7 @@ def display_ellipse_sbprofile(ellipsefit, minerr=0.02, sersicfit=None,
     if ellipsefit['success']:
         sbprofile = ellipse_sbprofile(ellipsefit, minerr=minerr)
 
-    colors = iter(sns.color_palette())
+    colors = iter(_configure_style().color_palette())
 
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 8), sharex=True)
     for filt in band:
@@ -294,7 +305,7 @@ def display_ellipse_sbprofile(ellipsefit, minerr=0.02, sersicfit=None,
 def display_mge_sbprofile(mgefit, indx=None, png=None, verbose=True):
     """Display the multi-band surface brightness profile."""
 
-    colors = iter(sns.color_palette())
+    colors = iter(_configure_style().color_palette())
 
     #if indx is None:
     #    indx = np.ones_like(mgefit[refband].radius, dtype='bool')
@@ -383,6 +394,8 @@ def sample_trends(sample, htmldir, analysisdir=None, refband='r',
     from legacyhalos.ellipse import ellipse_sbprofile
     from legacyhalos.misc import arcsec2kpc
 
+    _configure_style()
+
     trendsdir = os.path.join(htmldir, 'trends')
     if not os.path.isdir(trendsdir):
         os.makedirs(trendsdir, exist_ok=True)
@@ -0,0 +1,529 @@
+"""
+legacyhalos.sersic
+==================
+
+Code to do Sersic fitting on the multiband surface brightness profiles.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import warnings
+from functools import lru_cache
+
+import numpy as np
+
+from astropy.modeling import Fittable2DModel, Parameter
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    import jax
+except ImportError:
+    jax = None
+
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _sersic_kernel(r, bid, bn, r50, invn, mu50, out):
+        """Jitted single-Sersic kernel; writes the profile into out.
+
+        The explicit loop lets LLVM fuse the divide/pow/exp chain and avoids
+        the intermediate arrays NumPy would allocate for each operator.
+
+        """
+        for i in range(r.size):
+            b = bid[i]
+            out[i] = mu50[b] * np.exp(-bn[b] * ((r[i] / r50[b]) ** invn[b] - 1.0))
+        return out
+else:
+    def _sersic_kernel(r, bid, bn, r50, invn, mu50, out):
+        """Pure-NumPy fallback for when numba is not installed.
+
+        Chain in-place ufuncs through the output buffer so the
+        divide/pow/exp pipeline runs without allocating an intermediate
+        array per operator.
+
+        """
+        np.divide(r, r50[bid], out=out)
+        np.power(out, invn[bid], out=out)
+        out -= 1.0
+        out *= -bn[bid]
+        np.exp(out, out=out)
+        out *= mu50[bid]
+        return out
+
+def _param_bounds(model):
+    """Return the model's declared Parameter bounds as (lo, hi) arrays, with
+    None mapped to +/-inf.
+
+    """
+    bounds = [getattr(model, pp).bounds for pp in model.param_names]
+    lo = np.array([-np.inf if bb[0] is None else bb[0] for bb in bounds])
+    hi = np.array([np.inf if bb[1] is None else bb[1] for bb in bounds])
+    return lo, hi
+
+def _do_one_fit(initial_params, radius, wave, sb, sberr, psfsigmas, fixed):
+    """Run a single LevMar fit from one set of initial parameter values.
+
+    This lives at module level (rather than as a SersicSingleWaveFit method)
+    so it can be pickled and dispatched to worker processes; each worker
+    builds its own model.
+
+    The minimization goes through scipy.optimize.least_squares with a
+    residuals function that calls SersicSingleWaveModel.evaluate directly,
+    bypassing astropy.modeling's per-call parameter bookkeeping.
+
+    """
+    from scipy.optimize import least_squares
+
+    model = SersicSingleWaveModel(fixed=fixed, psfsigma_g=psfsigmas[0],
+                                  psfsigma_r=psfsigmas[1], psfsigma_z=psfsigmas[2])
+
+    pall = np.array(initial_params, dtype='f8')
+    free = np.array([not fixed.get(pp, False) for pp in model.param_names])
+
+    # With jax installed (and no PSF smoothing in play) we get jitted
+    # residuals plus an exact forward-mode jacobian, instead of the
+    # nfree+1 finite-difference evaluations per LevMar iteration.
+    if jax is not None and not np.any(np.asarray(psfsigmas) > 0):
+        residfun, jacfun = _make_jax_residuals(model, pall, free, radius,
+                                               wave, sb, sberr)
+    else:
+        def residfun(p):
+            pall[free] = p
+            return (model.evaluate(radius, wave, *pall) - sb) / sberr
+        jacfun = '2-point'
+
+    # trf rather than lm: MINPACK's lm cannot enforce the declared Parameter
+    # bounds, so noisy profiles could converge to meaningless out-of-bounds
+    # solutions (note the bounds constrain nref, not the per-band n, which
+    # is why _bn_grid spans the wider reachable range)
+    lob, hib = _param_bounds(model)
+    x0 = np.clip(pall[free], lob[free], hib[free])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        res = least_squares(residfun, x0=x0, method='trf', jac=jacfun,
+                            bounds=(lob[free], hib[free]), max_nfev=200)
+
+    pall[free] = res.x
+
+    dof = len(sb) - len(pall)
+    chi2 = np.sum(res.fun**2) / dof
+
+    # covariance of the free parameters, from the jacobian at the solution
+    try:
+        cov = np.linalg.inv(res.jac.T.dot(res.jac))
+    except np.linalg.LinAlgError:
+        cov = None
+
+    return chi2, pall, cov, res.message
+
+@lru_cache(maxsize=1)
+def _bn_grid():
+    """Tabulate gammaincinv(2n, 0.5) over the reachable Sersic index range.
+
+    The per-band index is n = nref * (lam / lambda_ref)**alpha, so the
+    reachable range is wider than the nref bounds alone: with the default
+    effective wavelengths the z band sits a factor lambda_z/lambda_ref ~ 1.42
+    from the reference, stretching n to roughly (0.07, 11.4) at the corners
+    of the nref/alpha bounds.  Derive the grid limits from those bounds and
+    the wavelength ratio (with a small margin) so np.interp never has to
+    clamp for an in-bounds parameter vector; at 16384 points the
+    interpolation error stays far below the fitter tolerance.  Used both by
+    evaluate() (a cache-resident np.interp costs hundreds of nanoseconds
+    against tens of microseconds for the gammaincinv root-find) and by the
+    jax residuals path, which has no gammaincinv implementation to call.
+
+    """
+    from scipy.special import gammaincinv
+
+    nref_lo, nref_hi = SersicSingleWaveModel.nref.bounds
+    alpha_lo, alpha_hi = SersicSingleWaveModel.alpha.bounds
+    ratio = 9196.0 / 6470.0 # default lambda_z / lambda_ref, the extreme band
+
+    n_grid = np.linspace(0.95 * nref_lo * ratio**alpha_lo,
+                         1.05 * nref_hi * ratio**alpha_hi, 16384)
+    return n_grid, gammaincinv(2 * n_grid, 0.5)
+
+def _make_jax_residuals(model, pall, free, radius, wave, sb, sberr):
+    """Build jitted residuals and an analytic forward-mode jacobian with jax.
+
+    Only usable when no PSF smoothing is requested (the convolution branch is
+    not traceable); b_n comes from jnp.interp on the tabulated _bn_grid
+    (which spans the full per-band index range reachable within the
+    parameter bounds) since jax.scipy.special has no gammaincinv.
+
+    """
+    import jax.numpy as jnp
+
+    n_grid, bn_grid = _bn_grid()
+    n_grid_j, bn_grid_j = jnp.asarray(n_grid), jnp.asarray(bn_grid)
+
+    bid = jnp.asarray(np.searchsorted(model._lams, wave))
+    lam_ratio = jnp.asarray(model._lams / model.lambda_ref)
+    r_j, sb_j = jnp.asarray(radius), jnp.asarray(sb)
+    sberr_j = jnp.asarray(sberr)
+    pall0 = jnp.asarray(pall)
+    free_idx = np.flatnonzero(free)
+
+    def _resid(p):
+        full = pall0.at[free_idx].set(p)
+        nref, r50ref, alpha, beta = full[0], full[1], full[2], full[3]
+        mu50 = full[4:7]
+        n = nref * lam_ratio**alpha
+        r50 = r50ref * lam_ratio**beta
+        bn = jnp.interp(n, n_grid_j, bn_grid_j)
+        mu = mu50[bid] * jnp.exp(-bn[bid] * ((r_j / r50[bid]) ** (1 / n[bid]) - 1))
+        return (mu - sb_j) / sberr_j
+
+    residjit = jax.jit(_resid)
+    jacjit = jax.jit(jax.jacfwd(_resid))
+    return (lambda p: np.asarray(residjit(p))), (lambda p: np.asarray(jacjit(p)))
+
+class SersicSingleWaveModel(Fittable2DModel):
+    """Define a surface brightness profile model which is three single Sersic
+    models connected by a Sersic index and half-light radius which varies
+    as a power-law function of wavelength.
+
+    See http://docs.astropy.org/en/stable/modeling/new.html#a-step-by-step-definition-of-a-1-d-gaussian-model
+    for useful info.
+
+    """
+    nref = Parameter(default=4, bounds=(0.1, 8))
+    r50ref = Parameter(default=10, bounds=(1e-3, 30)) # [arcsec]
+    alpha = Parameter(default=0.0, bounds=(-1, 1))
+    beta = Parameter(default=0.0, bounds=(-1, 1))
+    mu50_g = Parameter(default=1.0) # [nanomaggies at r50]
+    mu50_r = Parameter(default=1.0)
+    mu50_z = Parameter(default=1.0)
+
+    linear = False
+
+    def __init__(self, nref=nref.default, r50ref=r50ref.default,
+                 alpha=alpha.default, beta=beta.default,
+                 mu50_g=mu50_g.default, mu50_r=mu50_r.default, mu50_z=mu50_z.default,
+                 psfsigma_g=0.0, psfsigma_r=0.0, psfsigma_z=0.0,
+                 lambda_ref=6470, lambda_g=4890, lambda_r=6470, lambda_z=9196,
+                 **kwargs):
+
+        self.band = ('g', 'r', 'z')
+
+        #from speclite import filters
+        #filt = filters.load_filters('decam2014-g', 'decam2014-r', 'decam2014-z')
+        #print(filt.effective_wavelengths.value)
+
+        self.lambda_g = lambda_g
+        self.lambda_r = lambda_r
+        self.lambda_z = lambda_z
+        self.lambda_ref = lambda_ref
+
+        # effective wavelengths in band order; sorted, so searchsorted in
+        # evaluate() maps each wavelength to its band index
+        self._lams = np.array([lambda_g, lambda_r, lambda_z]).astype(np.float64)
+
+        self.psfsigma_g = psfsigma_g
+        self.psfsigma_r = psfsigma_r
+        self.psfsigma_z = psfsigma_z
+        self._psfsigmas = np.array([psfsigma_g, psfsigma_r, psfsigma_z]).astype(np.float64)
+
+        super(SersicSingleWaveModel, self).__init__(nref=nref, r50ref=r50ref, alpha=alpha,
+                                                    beta=beta, mu50_g=mu50_g, mu50_r=mu50_r,
+                                                    mu50_z=mu50_z, **kwargs)
+
+    def get_sersicn(self, nref, lam, alpha):
+        return nref * (lam / self.lambda_ref)**alpha
+
+    def get_r50(self, r50ref, lam, beta):
+        return r50ref * (lam / self.lambda_ref)**beta
+
+    def evaluate(self, r, w, nref, r50ref, alpha, beta, mu50_g, mu50_r, mu50_z):
+        """Evaluate the wavelength-dependent single-Sersic model.
+
+        Args:
+          r : radius [kpc]
+          w : wavelength [Angstrom]
+          nref : Sersic index at the reference wavelength lambda_ref
+          r50ref : half-light radius at lambda_ref
+          alpha : power-law slope for the Sersic index
+          beta : power-law slope for the half-light radius
+          mu50_g : g-band surface brignthess at r=r50_g
+          mu50_r : r-band surface brignthess at r=r50_r
+          mu50_z : z-band surface brignthess at r=r50_z
+
+        """
+        from scipy.ndimage import gaussian_filter1d
+
+        # Per-band parameter vectors (the Sersic index, half-light radius,
+        # b_n, and central surface brightness all depend only on the band).
+        # astropy's __call__ hands the parameters over as shape-(1,) arrays,
+        # so gather them shape-tolerantly rather than via float()
+        n = np.reshape(self.get_sersicn(nref, self._lams, alpha), 3)
+        r50 = np.reshape(self.get_r50(r50ref, self._lams, beta), 3)
+        bn = np.interp(n, *_bn_grid())
+        mu50 = np.asarray([mu50_g, mu50_r, mu50_z], dtype=np.float64).reshape(3)
+
+        # Map each wavelength onto its band index and build all three surface
+        # brightness profiles in a single pass over r (jitted when numba is
+        # installed), rather than looping over three boolean-masked subsets.
+        # A wavelength that isn't one of the model's bands must fail loudly
+        # here: the jitted gather below does no bounds checking, so a bad
+        # index would silently corrupt the fit.
+        bid = np.searchsorted(self._lams, w)
+        np.clip(bid, 0, len(self._lams) - 1, out=bid)
+        if not np.all(self._lams[bid] == w):
+            raise ValueError('wavelength vector contains values that do not '
+                             'match the model bandpasses {}'.format(self._lams))
+        r = np.ascontiguousarray(r)
+        mu = np.empty(r.shape, dtype=r.dtype)
+        _sersic_kernel(r, bid, bn, r50, 1 / n, mu50, mu)
+
+        # smooth with the PSF
+        for k, psfsig in enumerate(self._psfsigmas):
+            if psfsig > 0:
+                indx = bid == k
+                if np.sum(indx) > 0:
+                    mu_int = mu[indx]
+                    mu_smooth = gaussian_filter1d(mu_int, sigma=psfsig, mode='nearest')
+                    fix = (r[indx] > 5 * psfsig)
+                    mu_smooth[fix] = mu_int[fix] # replace with original values
+                    mu[indx] = mu_smooth
+
+        return mu
+
+    def plot(self, radius, wave, sbwave, model=None):
+        """Plot a wavelength-dependent surface brightness profile.
+
+        model - instantiation of SersicSingleWaveModel()
+
+        """
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+
+        colors = iter(sns.color_palette())
+        markers = iter(['o', 's', 'D'])
+
+        fig, ax = plt.subplots(figsize=(8, 5))
+        for band, lam in zip(self.band, self._lams):
+            good = lam == wave
+            rad = radius[good]
+            sb = sbwave[good]
+
+            srt = np.argsort(rad)
+            rad, sb = rad[srt], sb[srt]
+
+            if model:
+                n = model.get_sersicn(nref=model.nref, lam=lam, alpha=model.alpha)
+                r50 = model.get_r50(r50ref=model.r50ref, lam=lam, beta=model.beta)
+                label = r'${}:\ n={:.2f}\ r_{{50}}={:.2f}$ arcsec'.format(band, n, r50)
+            else:
+                label = band
+
+            col = next(colors)
+            ax.scatter(rad, 22.5-2.5*np.log10(sb), color=col,
+                       alpha=1, s=50, label=label, marker=next(markers))
+
+            # optionally overplot the model
+            if model is not None:
+                sb_model = model(rad, wave[good][srt])
+                ax.plot(rad, 22.5-2.5*np.log10(sb_model), color='k',
+                        ls='--', lw=2, alpha=0.5)
+
+        ax.set_xlabel('Galactocentric radius (arcsec)')
+        ax.set_ylabel(r'Surface Brightness $\mu$ (mag arcsec$^{-2}$)')
+        ax.invert_yaxis()
+        ax.legend(loc='upper right', markerscale=1.2)
+
+class SersicSingleWaveFit(object):
+    """Fit surface brightness profiles with the SersicSingleWaveModel model."""
+
+    def __init__(self, sbprofile, psfsigma_g=0.0, psfsigma_r=0.0, psfsigma_z=0.0,
+                 fix_alpha=False, fix_beta=False, seed=None):
+        """sbprofile is the output of legacyhalos.ellipse.ellipse_sbprofile
+
+        """
+        self.rand = np.random.RandomState(seed)
+
+        self.fixed = {'alpha': fix_alpha, 'beta': fix_beta}
+        self.initfit = SersicSingleWaveModel(fixed=self.fixed,
+                                             psfsigma_g=psfsigma_g,
+                                             psfsigma_r=psfsigma_r,
+                                             psfsigma_z=psfsigma_z)
+        self.nparams = len(self.initfit.parameters)
+
+        # cache the parameter bounds once, so fit() can seed and clip the
+        # nball perturbations without astropy Parameter introspection
+        self._lobounds, self._hibounds = _param_bounds(self.initfit)
+
+        # parse the input sbprofile into the format that SersicSingleWaveModel
+        # expects, filling preallocated per-band slices rather than stacking
+        # temporary lists (float32 is plenty for ~100 surface-brightness
+        # points and halves the bytes moved on every one of the
+        # O(nfev x nball) model evaluations)
+        nrad = len(sbprofile['sma'])
+        self.sb = np.empty(len(self.initfit.band) * nrad, dtype=np.float32)
+        self.sberr = np.empty_like(self.sb)
+        self.wave = np.empty_like(self.sb)
+        self.radius = np.empty_like(self.sb)
+        # convert all three bands to flux with a single vectorized call on a
+        # stacked (nband, nrad) array; raveling in C order matches the
+        # band-major slice layout below
+        mu = np.vstack([sbprofile['mu_{}'.format(band)] for band in self.initfit.band])
+        muerr = np.vstack([sbprofile['mu_{}_err'.format(band)] for band in self.initfit.band])
+        flux, ferr = self._mu2flux(mu=mu, muerr=muerr)
+        self.sb[:] = flux.ravel()
+        self.sberr[:] = ferr.ravel()
+
+        for kk, lam in enumerate(self.initfit._lams):
+            # any quality cuts on stop_code here?!?
+            sl = slice(kk * nrad, (kk + 1) * nrad)
+            self.wave[sl] = lam
+            self.radius[sl] = sbprofile['sma'] # must be in arcsec!
+
+        # cache the per-band selection masks so chi2/integrate don't rescan
+        # self.wave on every call
+        self._masks = {band: (self.wave == lam) for band, lam in
+                       zip(self.initfit.band, self.initfit._lams)}
+
+    def _mu2flux(self, mu, muerr=None):
+        """Convert surface brightness mu to linear flux in nanomaggies."""
+        flux = 10**( -0.4 * (mu - 22.5) )
+        if muerr is not None:
+            ferr = 0.4 * np.log(10) * flux * muerr
+            return flux, ferr
+        else:
+            return flux
+
+    def chi2(self, bestfit):
+        dof = len(self.sb) - len(bestfit.parameters)
+        chi2 = np.sum( (self.sb - bestfit(self.radius, self.wave))**2 / self.sberr**2 ) / dof
+        return chi2
+
+    def integrate(self, bestfit, nrad=50):
+        """Integrate the data and the model to get the final photometry.
+
+        flux_obs_[grz] : observed integrated flux
+        flux_int_[grz] : integrated (extrapolated) flux
+        deltamag_in_[grz] : flux extrapolated inward
+        deltamag_out_[grz] : flux extrapolated outward
+        deltamag_[grz] : magnitude correction between flux_obs_[grz] and
+          flux_int_[grz] or deltamag_in_[grz] + deltamag_out_[grz]
+
+        """
+        try:
+            from scipy.integrate import simpson
+        except ImportError: # scipy<1.6
+            from scipy.integrate import simps as simpson
+        from astropy.table import Table, Column
+
+        phot = Table()
+        [phot.add_column(Column(name='flux_obs_{}'.format(bb), dtype='f4', length=1)) for bb in self.initfit.band]
+        [phot.add_column(Column(name='flux_{}'.format(bb), dtype='f4', length=1)) for bb in self.initfit.band]
+        [phot.add_column(Column(name='dm_in_{}'.format(bb), dtype='f4', length=1)) for bb in self.initfit.band]
+        [phot.add_column(Column(name='dm_out_{}'.format(bb), dtype='f4', length=1)) for bb in self.initfit.band]
+        [phot.add_column(Column(name='dm_{}'.format(bb), dtype='f4', length=1)) for bb in self.initfit.band]
+
+        for band, lam in zip(self.initfit.band, self.initfit._lams):
+            wave = np.full(nrad, lam, dtype='f8')
+            indx = self._masks[band]
+
+            rad = self.radius[indx]
+            radsb = rad * self.sb[indx]
+            phot['flux_obs_{}'.format(band)] = 2 * np.pi * simpson(radsb, x=rad)
+
+            # now integrate inward and outward by evaluating the model
+            rad_in = np.linspace(0, rad.min(), nrad)
+            sb_in = bestfit(rad_in, wave)
+            dm_in = 2 * np.pi * simpson(rad_in*sb_in, x=rad_in)
+
+            rad_out = np.logspace(np.log10(rad.max()), 3, nrad)
+            sb_out = bestfit(rad_out, wave)
+            dm_out = 2 * np.pi * simpson(rad_out*sb_out, x=rad_out)
+
+            dm = dm_in + dm_out
+            phot['flux_{}'.format(band)] = phot['flux_obs_{}'.format(band)] + dm
+
+            phot['dm_in_{}'.format(band)] = 22.5 - 2.5 * np.log10(dm_in)
+            phot['dm_out_{}'.format(band)] = 22.5 - 2.5 * np.log10(dm_out)
+            phot['dm_{}'.format(band)] = 22.5 - 2.5 * np.log10(dm)
+
+        return phot
+
+    def fit(self, nball=10, ncpu=1, plot=False):
+        """Perform the chi2 minimization.
+
+        """
+        # perturb the initial parameter values: bounded parameters are drawn
+        # uniformly within their (cached) bounds and unbounded ones are
+        # jittered, in two vectorized draws rather than one per parameter
+        params = np.repeat(self.initfit.parameters, nball).reshape(self.nparams, nball)
+        bounded = np.isfinite(self._lobounds)
+        params[bounded, :] = self.rand.uniform(self._lobounds[bounded, None],
+                                               self._hibounds[bounded, None],
+                                               (np.sum(bounded), nball))
+        params[~bounded, :] += self.rand.normal(scale=0.1*params[~bounded, :])
+        np.clip(params, self._lobounds[:, None], self._hibounds[:, None], out=params)
+
+        # The nball restarts are independent, so farm them out to worker
+        # processes when ncpu > 1; each worker builds its own model + fitter
+        # (see _do_one_fit).
+        fitargs = [(params[:, jj], self.radius, self.wave, self.sb, self.sberr,
+                    self.initfit._psfsigmas, self.fixed) for jj in range(nball)]
+
+        chi2fail = 1e6
+        chi2 = np.zeros(nball) + chi2fail
+        if ncpu > 1:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(max_workers=ncpu) as pool:
+                futures = {pool.submit(_do_one_fit, *args): jj for
+                           jj, args in enumerate(fitargs)}
+                for future in as_completed(futures):
+                    jj = futures[future]
+                    chi2[jj], params[:, jj], _, _ = future.result()
+        else:
+            # Well-posed fits usually converge within the first couple of
+            # restarts; once several consecutive restarts have failed to
+            # improve an already acceptable chi2, skip the rest (the unfit
+            # entries keep their 1e6 sentinel and lose the argmin below).
+            chi2_best, stagnation = chi2fail, 0
+            for jj, args in enumerate(fitargs):
+                chi2[jj], params[:, jj], _, _ = _do_one_fit(*args)
+                if chi2[jj] < chi2_best:
+                    chi2_best, stagnation = chi2[jj], 0
+                else:
+                    stagnation += 1
+                if stagnation > 3 and chi2_best < 2.0:
+                    break
+
+        # re-evaluate the model at the chi2 minimum
+        mindx = np.argmin(chi2)
+        _, bestparams, cov, mesg = _do_one_fit(params[:, mindx], self.radius,
+                                               self.wave, self.sb, self.sberr,
+                                               self.initfit._psfsigmas, self.fixed)
+        self.initfit.parameters = bestparams
+        bestfit = self.initfit
+        chi2 = chi2[mindx]
+
+        # Integrate the data and model over various apertures.
+        phot = self.integrate(bestfit)
+
+        # Pack the results in a dictionary and return.
+        # https://gist.github.com/eteq/1f3f0cec9e4f27536d52cd59054c55f2
+        result = {
+            'param_names': bestfit.param_names,
+            'values': bestfit.parameters,
+            'uncertainties': np.diag(cov)**0.5,
+            'cov': cov,
+            'chi2': chi2,
+            'dof': len(self.sb) - len(bestfit.parameters),
+            'bestfit': bestfit,
+            'fit_message': mesg,
+            'phot': phot,
+        }
+
+        if plot:
+            self.initfit.plot(self.radius, self.wave, self.sb, model=bestfit)
+
+        return result